@@ -1,6 +1,20 @@
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+from types import MappingProxyType
+from typing import NamedTuple
+
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
 import numpy as np
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
 
 # -------------------- PAGE CONFIG --------------------
 st.set_page_config(
@@ -20,6 +34,15 @@ HEADERS = {
     "X-RapidAPI-Host": "api-football-v1.p.rapidapi.com"
 }
 
+STANDINGS_URL = "https://api-football-v1.p.rapidapi.com/v3/standings"
+STANDINGS_TTL = 3600
+
+# On-disk copy of recent standings so a server restart doesn't re-hit the API.
+# The in-memory cache holds a disk hit for another STANDINGS_TTL, so served data
+# is at most DISK_MAX_AGE + STANDINGS_TTL (1.5x the TTL) old.
+STANDINGS_DB = "standings_cache.sqlite3"
+DISK_MAX_AGE = STANDINGS_TTL // 2
+
 # -------------------- LEAGUE MAP --------------------
 LEAGUES = {
     "Premier League": 39,
@@ -31,80 +54,282 @@ LEAGUES = {
 
 CURRENT_SEASON = 2024
 
+# Longest the first render waits on the other leagues before showing the page
+PREFETCH_TIMEOUT = 10
+
+# -------------------- MODEL CONFIG --------------------
+# Per-team stat layout: league position, goals scored per game, goals conceded per game
+POS, GF, GA = range(3)
+
+# Applied to (home - away); a lower position and fewer goals conceded favour home
+WEIGHTS = np.array([-0.6, 1.3, -1.0], dtype=np.float64)
+HOME_ADVANTAGE = 0.4
+DRAW_WEIGHT = 0.22
+
+# Percentage-point gap between home and away win chances that counts as "High"
+CONFIDENCE_MARGIN = 15
+
+# Everything the UI needs for one league, built once per standings fetch
+class LeagueSnapshot(NamedTuple):
+    index: MappingProxyType  # team name -> row in stats
+    stats: np.ndarray        # (N, 3) per-team stats
+    teams: tuple             # sorted team names
+    probs: np.ndarray        # (N, N, 3) home/draw/away % for home row i vs away row j
+    confidence: np.ndarray   # (N, N) "High"/"Medium" label for home row i vs away row j
+
 # -------------------- DATA FETCH --------------------
-@st.cache_data(ttl=3600)
-def fetch_standings(league_id, season):
-    url = "https://api-football-v1.p.rapidapi.com/v3/standings"
+# One pooled session per process so repeat fetches reuse the open TLS connection
+@st.cache_resource(show_spinner=False)
+def get_session():
+    session = requests.Session()
+    session.headers.update(HEADERS)
+
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.3)
+    )
+    session.mount("https://", adapter)
+
+    return session
+
+def open_disk_cache():
+    conn = sqlite3.connect(STANDINGS_DB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS standings "
+        "(key TEXT PRIMARY KEY, fetched_at REAL, payload BLOB)"
+    )
+    return conn
+
+def read_disk_cache(key):
+    try:
+        with closing(open_disk_cache()) as conn:
+            row = conn.execute(
+                "SELECT fetched_at, payload FROM standings WHERE key = ?", (key,)
+            ).fetchone()
+    except sqlite3.Error as exc:
+        logger.warning("Standings disk cache unavailable: %s", exc)
+        return None
+
+    if row is None or time.time() - row[0] > DISK_MAX_AGE:
+        return None
+
+    # A corrupt or old-format entry is just a miss; the caller refetches and overwrites it
+    try:
+        standings = orjson.loads(row[1])
+    except orjson.JSONDecodeError:
+        logger.warning("Ignoring unreadable disk cache entry %s", key)
+        return None
+
+    if not isinstance(standings, list) or not all(
+        isinstance(r, list) and len(r) == 5 for r in standings
+    ):
+        logger.warning("Ignoring malformed disk cache entry %s", key)
+        return None
+
+    return standings
+
+def write_disk_cache(key, standings):
+    try:
+        with closing(open_disk_cache()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO standings VALUES (?, ?, ?)",
+                (key, time.time(), orjson.dumps(standings))
+            )
+    except sqlite3.Error as exc:
+        logger.warning("Standings disk cache unavailable: %s", exc)
+
+# Returns (name, rank, played, goals for, goals against), or None if any field is
+# missing or not an int
+def parse_standings_row(row):
+    team = row.get("team") if isinstance(row, dict) else None
+    totals = row.get("all") if isinstance(row, dict) else None
+    goals = totals.get("goals") if isinstance(totals, dict) else None
+    if not isinstance(team, dict) or not isinstance(goals, dict):
+        return None
+
+    name = team.get("name")
+    numbers = (row.get("rank"), totals.get("played"), goals.get("for"), goals.get("against"))
+    if not isinstance(name, str) or not all(type(n) is int for n in numbers):
+        return None
+
+    return (name, *numbers)
+
+def request_standings(league_id, season):
     params = {"league": league_id, "season": season}
 
-    response = requests.get(url, headers=HEADERS, params=params, timeout=20)
-    data = response.json()
+    try:
+        response = get_session().get(STANDINGS_URL, params=params, timeout=20)
+    except requests.RequestException as exc:
+        logger.warning("Standings request for league %s failed: %s", league_id, exc)
+        return []
+
+    try:
+        data = orjson.loads(response.content) if response.ok else {}
+    except orjson.JSONDecodeError:
+        logger.warning(
+            "Standings for league %s season %s were not valid JSON (HTTP %s)",
+            league_id, season, response.status_code
+        )
+        return []
+
+    # Quota or key errors come back without a "response" payload, and an
+    # unstarted season can come back with an empty "standings" list
+    leagues = data.get("response") if isinstance(data, dict) else None
+    league = leagues[0].get("league") if leagues else None
+    groups = league.get("standings") if league else None
+    if not groups or not groups[0]:
+        logger.warning(
+            "No standings for league %s season %s (HTTP %s)",
+            league_id, season, response.status_code
+        )
+        return []
+
+    # Keep only the fields the model reads; the rest of the payload is dropped here
+    rows = []
+    for row in groups[0]:
+        parsed = parse_standings_row(row)
+        if parsed is None:
+            logger.warning(
+                "Skipping malformed standings row for league %s season %s: %r",
+                league_id, season, row
+            )
+            continue
+        rows.append(parsed)
+
+    return rows
+
+# Held as a shared resource: reruns read the same snapshot instead of unpickling a copy
+@st.cache_resource(ttl=STANDINGS_TTL, show_spinner=False)
+def fetch_standings(league_id, season):
+    key = f"rows:{league_id}:{season}"
+
+    standings = read_disk_cache(key)
+    if standings is None:
+        standings = request_standings(league_id, season)
+        if standings:
+            write_disk_cache(key, standings)
+
+    # One contiguous row per team, looked up by name through `index`
+    index = {}
+    stats = np.empty((len(standings), 3), dtype=np.float64)
+    for i, (team, rank, played, gf, ga) in enumerate(standings):
+        inv_played = 1.0 / max(played, 1)
+
+        stats[i, POS] = rank
+        stats[i, GF] = gf * inv_played
+        stats[i, GA] = ga * inv_played
 
-    standings = data["response"][0]["league"]["standings"][0]
+        index[team] = i
 
-    teams = {}
-    for row in standings:
-        team = row["team"]["name"]
-        played = row["all"]["played"]
-        gf = row["all"]["goals"]["for"]
-        ga = row["all"]["goals"]["against"]
+    # Every home/away pairing is scored up front, so a predict click is a table read
+    probs = predict_matches(stats[:, None, :], stats[None, :, :])
+    confidence = np.where(
+        np.abs(probs[..., 0] - probs[..., 2]) > CONFIDENCE_MARGIN, "High", "Medium"
+    )
 
-        teams[team] = {
-            "position": row["rank"],
-            "gf": gf / max(played, 1),
-            "ga": ga / max(played, 1)
-        }
+    # The snapshot is shared by every session, so hand out read-only views
+    stats.setflags(write=False)
+    probs.setflags(write=False)
+    confidence.setflags(write=False)
 
-    return teams
+    # Sorted once per snapshot; a tuple keeps the selectbox options stable across reruns
+    teams = tuple(sorted(index))
+
+    return LeagueSnapshot(MappingProxyType(index), stats, teams, probs, confidence)
+
+# Warms one league's cache entry. A fetch that raises or comes back empty is left
+# uncached, so selecting that league later fetches it live on the script thread.
+def prefetch_league(league_id, season):
+    try:
+        league = fetch_standings(league_id, season)
+    except Exception as exc:
+        logger.warning("Prefetching league %s failed: %r", league_id, exc)
+        return
+
+    if not league.teams:
+        fetch_standings.clear(league_id, season)
+
+# Fetch every competition concurrently once per TTL window, so switching leagues
+# never waits on the API; the requests are I/O-bound and release the GIL
+@st.cache_resource(ttl=STANDINGS_TTL, show_spinner="Loading league tables...")
+def prefetch_standings(season):
+    # Workers share this run's context so the cache calls inside them are tracked normally
+    ctx = get_script_run_ctx()
+    pool = ThreadPoolExecutor(
+        max_workers=len(LEAGUES), initializer=add_script_run_ctx, initargs=(None, ctx)
+    )
+    futures = {
+        pool.submit(prefetch_league, league_id, season): league_id
+        for league_id in LEAGUES.values()
+    }
+
+    # Stragglers keep running and fill the cache when they finish; the page doesn't wait
+    done, pending = wait(futures, timeout=PREFETCH_TIMEOUT)
+    pool.shutdown(wait=False)
+
+    for future in pending:
+        logger.warning("Prefetching league %s is still running", futures[future])
 
 # -------------------- PREDICTION LOGIC --------------------
-def predict_match(home, away):
-    score = 0
+# home/away are (..., 3) stat rows that broadcast against each other; returns
+# (..., 3) percentages ordered home, draw, away
+def predict_matches(home, away):
+    scores = (home - away) @ WEIGHTS + HOME_ADVANTAGE
+
+    home_prob = 1.0 / (1.0 + np.exp(-scores))
+    away_prob = 1.0 - home_prob
+    draw_prob = np.full_like(home_prob, DRAW_WEIGHT)
 
-    score += (away["position"] - home["position"]) * 0.6
-    score += (home["gf"] - away["gf"]) * 1.3
-    score += (away["ga"] - home["ga"]) * 1.0
-    score += 0.4  # home advantage
+    # home_prob + away_prob == 1, so every row normalizes by the same total
+    inv = 100.0 / (1.0 + DRAW_WEIGHT)
 
-    home_prob = 1 / (1 + np.exp(-score))
-    away_prob = 1 - home_prob
-    draw_prob = 0.22
+    return np.stack([home_prob, draw_prob, away_prob], axis=-1) * inv
 
-    total = home_prob + away_prob + draw_prob
-    home_prob = home_prob / total * 100
-    draw_prob = draw_prob / total * 100
-    away_prob = away_prob / total * 100
+# home_idx/away_idx are team rows in the snapshot, as scalars or equal-length arrays;
+# returns the (..., 3) home/draw/away percentages and matching confidence labels
+def predict_fixtures(league, home_idx, away_idx):
+    return league.probs[home_idx, away_idx], league.confidence[home_idx, away_idx]
 
-    confidence = "High" if abs(home_prob - away_prob) > 15 else "Medium"
+def predict_match(league, home_i, away_i):
+    (home_prob, draw_prob, away_prob), confidence = predict_fixtures(league, home_i, away_i)
 
     return {
-        "home": home_prob,
-        "draw": draw_prob,
-        "away": away_prob,
-        "confidence": confidence
+        "home": float(home_prob),
+        "draw": float(draw_prob),
+        "away": float(away_prob),
+        "confidence": str(confidence)
     }
 
 # -------------------- UI --------------------
 league_name = st.selectbox("Competition", LEAGUES.keys())
 league_id = LEAGUES[league_name]
 
-teams_data = fetch_standings(league_id, CURRENT_SEASON)
+prefetch_standings(CURRENT_SEASON)
 
-if not teams_data:
+# fetch_standings has no spinner of its own so prefetch workers never draw one;
+# a cleared or expired entry is fetched here, so show progress on the script thread
+with st.spinner(f"Loading {league_name} table..."):
+    league = fetch_standings(league_id, CURRENT_SEASON)
+
+if not league.teams:
+    # Don't hold an empty snapshot for the whole TTL; retry on the next rerun
+    fetch_standings.clear(league_id, CURRENT_SEASON)
     st.error("Unable to load league data.")
     st.stop()
 
-teams = sorted(teams_data.keys())
-
-col1, col2 = st.columns(2)
-home_team = col1.selectbox("🏠 Home Team", teams)
-away_team = col2.selectbox("✈️ Away Team", teams, index=1)
+# Team picks only take effect on submit, so changing them doesn't rerun the script
+with st.form("match_inputs"):
+    col1, col2 = st.columns(2)
+    home_team = col1.selectbox("🏠 Home Team", league.teams)
+    away_team = col2.selectbox("✈️ Away Team", league.teams, index=1)
 
-if st.button("🔮 Predict Match", type="primary", use_container_width=True):
-    home = teams_data[home_team]
-    away = teams_data[away_team]
+    submitted = st.form_submit_button(
+        "🔮 Predict Match", type="primary", use_container_width=True
+    )
 
-    result = predict_match(home, away)
+if submitted:
+    result = predict_match(league, league.index[home_team], league.index[away_team])
 
     st.markdown("---")
     st.subheader("Prediction")